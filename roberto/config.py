@@ -26,9 +26,8 @@ except ImportError:
     from importlib.resources import open_text
 
 from invoke.config import Config, merge_dicts, DataProxy
-import yaml
 
-from .utils import parse_git_describe
+from .utils import parse_git_describe, load_yaml
 from .tools import initialize_tools
 from .testenvs import init_testenv
 
@@ -117,7 +116,7 @@ class RobertoConfig(Config):
 
         # Load default configuration
         with open_text('roberto', 'default_config.yaml') as f:
-            defaults = merge_dicts(defaults, yaml.safe_load(f))
+            defaults = merge_dicts(defaults, load_yaml(f))
 
         # Git version and branch information
         try:
@@ -130,27 +129,18 @@ class RobertoConfig(Config):
             git_describe = '0.0.0-0-notag'
         defaults['git'].update(parse_git_describe(git_describe))
 
-        # First try to get a decent branch name
-        branch = subprocess.run(
-            ["git", "rev-parse", "--abbrev-ref", "HEAD"],
+        # Get the commit sha and a decent branch name with a single git call.
+        sha, branch = subprocess.run(
+            ["git", "rev-parse", "HEAD", "--abbrev-ref", "HEAD"],
             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-            check=True).stdout.decode('utf-8').strip()
-        # If that failed, try to get the tag
+            check=True).stdout.decode('utf-8').split()
+        # If that failed, use the tag when it points exactly at HEAD. This is
+        # already known from the output of git describe. Otherwise, just the sha.
         if branch == 'HEAD':
-            try:
-                branch = subprocess.run(
-                    ["git", "describe", "--tags", "--exact-match"],
-                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-                    check=True).stdout.decode('utf-8').strip()
-            except subprocess.CalledProcessError:
-                # Final attempt, just the sha.
-                try:
-                    branch = subprocess.run(
-                        ["git", "rev-parse", "HEAD"],
-                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
-                        check=True).stdout.decode('utf-8').strip()
-                except subprocess.CalledProcessError:
-                    branch = '__nogit__'
+            if defaults['git']['describe'] == defaults['git']['tag']:
+                branch = defaults['git']['tag']
+            else:
+                branch = sha
         defaults['git']['branch'] = branch
 
         return defaults
@@ -19,17 +19,20 @@
 """Installation of requirements."""
 
 
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import hashlib
+import json
+import mmap
 import os
 import tempfile
 import time
-from typing import Set
+from typing import List, Set
 
 from invoke import Context
-import yaml
 
 from .tools import TOOLS
+from .utils import load_yaml
 
 
 def compute_req_hash(req_items: Set[str], req_fns: Set[str]) -> str:
@@ -55,7 +58,11 @@ def compute_req_hash(req_items: Set[str], req_fns: Set[str]) -> str:
         hasher.update(req_fn.encode("utf-8"))
         if os.path.isfile(req_fn):
             with open(req_fn, 'br') as f:
-                hasher.update(f.read())
+                # Hash the page cache directly instead of copying the file
+                # contents. Empty files cannot be mapped and are skipped.
+                if os.fstat(f.fileno()).st_size > 0:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        hasher.update(mapped)
     return hasher.hexdigest()
 
 
@@ -77,50 +84,184 @@ def check_install_requirements(fn_skip: str, req_hash: str) -> bool:
     """
     # The install and update will be skipped if it was done already once,
     # less than 24 hours ago and the req_hash has not changed.
-    if os.path.isfile(fn_skip):
-        if (time.time() - os.path.getmtime(fn_skip)) < 24*3600:
-            with open(fn_skip) as f:
-                if f.read().strip() == req_hash:
-                    print("Skipping install+update of requirements.")
-                    print(f"To force install+update: rm {fn_skip}")
-                    return False
+    try:
+        age = time.time() - os.stat(fn_skip).st_mtime
+    except FileNotFoundError:
+        age = None
+    if age is not None and age < 24*3600:
+        with open(fn_skip) as f:
+            if f.read().strip() == req_hash:
+                print("Skipping install+update of requirements.")
+                print(f"To force install+update: rm {fn_skip}")
+                return False
     print("Starting install+update of requirements.")
     print(f"To skip install+update: echo {req_hash} > {fn_skip}")
     return True
 
 
+def iter_requirements(ctx: Context):
+    """Iterate over the requirements of the project and of all tools used.
+
+    Each tool is visited only once, even when it is used by several packages.
+
+    Parameters
+    ----------
+    ctx
+        A invoke.Context instance.
+
+    Yields
+    ------
+    conda_req, pip_req
+        The conda and pip names of a requirement, either may be None.
+
+    """
+    yield from ctx.project.requirements
+    toolnames = {}
+    for package in ctx.project.packages:
+        toolnames.update(dict.fromkeys(package.tools))
+    for toolname in toolnames:
+        yield from TOOLS[toolname].requirements
+
+
+RECIPE_REQUIREMENT_SOURCES = [
+    ("requirements", 'build'),
+    ("requirements", 'host'),
+    ("requirements", 'run'),
+    ("test", 'requires'),
+]
+
+
+def extract_recipe_requirements(rendered: dict, own_conda_reqs: List[str]) -> Set[str]:
+    """Build a (simplified) set of requirements from a rendered conda recipe.
+
+    Parameters
+    ----------
+    rendered
+        The rendered recipe, as loaded from the output of conda render. Only
+        the requirements and test sections are used.
+    own_conda_reqs
+        Conda packages of the project itself, which are not included.
+
+    Returns
+    -------
+    dep_conda_reqs
+        The names of all requirements, including version constraints if any.
+
+    """
+    dep_conda_reqs = set()
+    for req_section, req_type in RECIPE_REQUIREMENT_SOURCES:
+        for recipe_req in (rendered.get(req_section) or {}).get(req_type) or []:
+            words = recipe_req.split()
+            if words[0] not in own_conda_reqs:
+                dep_conda_req = words[0]
+                if len(words) > 1 and any(char in words[1] for char in "<>!="):
+                    dep_conda_req += " " + words[1]
+                dep_conda_reqs.add(dep_conda_req)
+    return dep_conda_reqs
+
+
+def render_recipe(ctx: Context, recipe_dir: str) -> dict:
+    """Render a conda recipe, reusing the result of a previous call if possible.
+
+    Rendered recipes are stored in the testenv, using a hash of the project
+    version, the variants, the channels and all files in the recipe directory
+    (including subdirectories) as key. Like installed requirements, a
+    rendered recipe is only reused for 24 hours, because the result also
+    depends on the packages available in the channels. Only the sections listed in
+    RECIPE_REQUIREMENT_SOURCES are stored, in JSON format, which is much
+    faster to load than the full YAML output of conda render.
+
+    Parameters
+    ----------
+    ctx
+        A invoke.Context instance.
+    recipe_dir
+        The directory containing the conda recipe.
+
+    Returns
+    -------
+    rendered
+        The relevant sections of the rendered recipe.
+
+    """
+    from glob import glob  # pylint: disable=import-outside-toplevel
+    render_hash = compute_req_hash(
+        {f"version:{ctx.git.tag_version}", f"variants:{ctx.conda.variants}",
+         f"channels:{' '.join(ctx.conda.channels)}"},
+        glob(os.path.join(recipe_dir, "**"), recursive=True)
+    )
+    cache_dir = os.path.join(ctx.testenv.path, ".render_cache")
+    fn_cached = os.path.join(cache_dir, render_hash + ".json")
+    try:
+        age = time.time() - os.stat(fn_cached).st_mtime
+    except FileNotFoundError:
+        age = None
+    if age is not None and age < 24*3600:
+        print(f"Reusing rendered recipe {fn_cached}")
+        with open(fn_cached) as f:
+            return json.load(f)
+    os.makedirs(cache_dir, exist_ok=True)
+    # Send the output of conda render to a temporary directory. Stdin is not
+    # forwarded, because this function may run in several threads at once,
+    # which would then compete for the terminal. conda render is not
+    # interactive anyway.
+    with tempfile.TemporaryDirectory() as tmpdir:
+        rendered_path = os.path.join(tmpdir, "rendered.yml")
+        ctx.run(
+            f"conda render -f {rendered_path} {recipe_dir} "
+            f"--variants {ctx.conda.variants}",
+            in_stream=False,
+        )
+        with open(rendered_path, 'rb') as f:
+            full = load_yaml(f)
+    rendered = {
+        req_section: full[req_section]
+        for req_section in dict.fromkeys(
+            req_section for req_section, _req_type in RECIPE_REQUIREMENT_SOURCES)
+        if req_section in full
+    }
+    # Write to a temporary file first, such that an interrupted write never
+    # leaves a truncated cache file behind.
+    fd_tmp, fn_tmp = tempfile.mkstemp(suffix=".json.tmp", dir=cache_dir)
+    try:
+        with os.fdopen(fd_tmp, 'w') as f:
+            json.dump(rendered, f)
+        os.replace(fn_tmp, fn_cached)
+    except BaseException:
+        os.remove(fn_tmp)
+        raise
+    return rendered
+
+
 # pylint: disable=too-many-branches,too-many-statements
 def install_requirements_conda(ctx: Context):
     """Install all requirements, including tools used by Roberto."""
+    from glob import glob  # pylint: disable=import-outside-toplevel
     # Collect all parameters determining the install commands (to good
     # approximation) and turn them into a hash.
     # Some conda requirements are included by default because they must be present:
     # - conda: to make sure it is always up to date.
     # - conda-build: to have conda-render for getting requirements from recipes.
-    conda_reqs = set(["conda"])
-    pip_reqs = set([])
+    conda_reqs = {"conda"}
+    pip_reqs = set()
     recipe_dirs = []
-    # Add project as a tool because it also contains requirements.
-    tools = [ctx.project]
     for package in ctx.project.packages:
-        for toolname in package.tools:
-            tools.append(ctx.tools[toolname])
         recipe_dir = os.path.join(package.path, "tools", "conda.recipe")
         if os.path.isdir(recipe_dir):
             recipe_dirs.append(recipe_dir)
         else:
             print(f"Skipping recipe {recipe_dir}. (directory does not exist)")
-    for tool in tools:
-        for conda_req, pip_req in tool.get("requirements", []):
-            if conda_req is None:
-                pip_reqs.add(pip_req)
-                conda_reqs.add("pip")
-            else:
-                conda_reqs.add(conda_req)
+    for conda_req, pip_req in iter_requirements(ctx):
+        if conda_req is None:
+            pip_reqs.add(pip_req)
+            conda_reqs.add("pip")
+        else:
+            conda_reqs.add(conda_req)
     req_hash = compute_req_hash(
         set("conda:" + conda_req for conda_req in conda_reqs) |
         set("pip:" + pip_req for pip_req in pip_reqs),
-        sum([glob(os.path.join(recipe_dir, "*")) for recipe_dir in recipe_dirs], [])
+        sum([glob(os.path.join(recipe_dir, "**"), recursive=True)
+             for recipe_dir in recipe_dirs], [])
     )
 
     fn_skip = os.path.join(ctx.testenv.path, ".skip_install")
@@ -135,50 +276,31 @@ def install_requirements_conda(ctx: Context):
             ctx.run(f"conda install --update-deps -y {conda_reqs_base_str}")
 
         with ctx.prefix(ctx.testenv.activate):
-            # Update packages already installed
-            ctx.run("conda update --all -y")
-
-            # Update and install other requirements for Roberto, in the dev env.
-            conda_reqs_dev_str = " ".join(
-                f"'{conda_req}'" for conda_req in conda_reqs
+            # Other requirements for Roberto, to be installed in the dev env.
+            conda_reqs_dev = set(
+                conda_req for conda_req in conda_reqs
                 if not conda_req.startswith('conda')
             )
-            ctx.run(f"conda install --update-deps -y {conda_reqs_dev_str}")
 
             print("Rendering conda package, extracting requirements, which will be installed.")
 
-            # Install dependencies from recipes, excluding own packages.
+            # Add dependencies from recipes, excluding own packages.
             own_conda_reqs = [package.dist_name for package in ctx.project.packages]
-            for recipe_dir in recipe_dirs:
-                # Send the output of conda render to a temporary directory.
-                with tempfile.TemporaryDirectory() as tmpdir:
-                    rendered_path = os.path.join(tmpdir, "rendered.yml")
-                    ctx.run(
-                        f"conda render -f {rendered_path} {recipe_dir} "
-                        f"--variants {ctx.conda.variants}"
-                    )
-                    with open(rendered_path) as f:
-                        rendered = yaml.safe_load(f)
-                # Build a (simplified) list of requirements and install.
-                dep_conda_reqs = set([])
-                req_sources = [
-                    ("requirements", 'build'),
-                    ("requirements", 'host'),
-                    ("requirements", 'run'),
-                    ("test", 'requires'),
-                ]
-                for req_section, req_type in req_sources:
-                    for recipe_req in rendered.get(req_section, {}).get(req_type, []):
-                        words = recipe_req.split()
-                        if words[0] not in own_conda_reqs:
-                            dep_conda_req = words[0]
-                            if len(words) > 1 and any(char in words[1] for char in "<>!="):
-                                dep_conda_req += " " + words[1]
-                            dep_conda_reqs.add(dep_conda_req)
-                conda_reqs_render_str = " ".join(
-                    f"'{conda_req}'" for conda_req in dep_conda_reqs
-                )
-                ctx.run(f"conda install --update-deps -y {conda_reqs_render_str}")
+            # The recipes are rendered concurrently because conda render is
+            # mostly waiting for subprocesses and I/O. The number of workers
+            # is limited because each conda render takes quite some memory.
+            max_workers = max(1, min(len(recipe_dirs), os.cpu_count() or 1, 8))
+            with ThreadPoolExecutor(max_workers) as executor:
+                rendered_recipes = list(executor.map(partial(render_recipe, ctx), recipe_dirs))
+            for rendered in rendered_recipes:
+                conda_reqs_dev.update(extract_recipe_requirements(rendered, own_conda_reqs))
+
+            # Install all of them and update all packages already installed
+            # at once, such that the solver runs only once.
+            conda_reqs_dev_str = " ".join(
+                f"'{conda_req}'" for conda_req in sorted(conda_reqs_dev)
+            )
+            ctx.run(f"conda install --update-all -y {conda_reqs_dev_str}")
 
             # Update and install requirements for Roberto from pip, if any.
             if pip_reqs:
@@ -213,40 +335,36 @@ def convert_requires(fn_requires, fn_requirements):
 def install_requirements_pip(ctx: Context):
     """Install requirements in the virtual environment."""
     # Collect all parameters determining installation of requirements
-    pip_reqs = set([])
-    req_fns = set([])
-    for _conda_req, pip_req in ctx.project.requirements:
+    pip_reqs = set()
+    req_fns = set()
+    for _conda_req, pip_req in iter_requirements(ctx):
         if pip_req is not None:
             pip_reqs.add(pip_req)
     for package in ctx.project.packages:
-        for toolname in package.tools:
-            tool = TOOLS[toolname]
-            for _conda_req, pip_req in tool.requirements:
-                if pip_req is not None:
-                    pip_reqs.add(pip_req)
         req_fns.add(os.path.join(package.path, "setup.py"))
     req_hash = compute_req_hash(pip_reqs, req_fns)
 
     fn_skip = os.path.join(ctx.testenv.path, ".skip_install")
     if check_install_requirements(fn_skip, req_hash):
-        with ctx.prefix(ctx.testenv.activate):
+        with ctx.prefix(ctx.testenv.activate), tempfile.TemporaryDirectory() as tmpdir:
             if len(pip_reqs) > 0:
                 # Upgrade pip
                 ctx.run("pip install -U pip")
-                # Install pip packages for the tools
-                pip_reqs_str = " ".join(f"'{pip_req}'" for pip_req in pip_reqs)
-                ctx.run(f"pip install -U {pip_reqs_str}")
-            # Install dependencies for the project.
-            for package in ctx.project.packages:
+            # Pip packages for the tools
+            pip_args = [f"'{pip_req}'" for pip_req in sorted(pip_reqs)]
+            # Dependencies for the project.
+            for ipackage, package in enumerate(ctx.project.packages):
                 with ctx.cd(package.path):
                     ctx.run("python setup.py egg_info")
-                    fn_requires = os.path.join(
-                        package.dist_name.replace("-", "_") + ".egg-info",
-                        "requires.txt")
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        fn_requirements = os.path.join(tmpdir, "requirements.txt")
-                        convert_requires(fn_requires, fn_requirements)
-                        ctx.run("pip install -U -r " + fn_requirements)
+                fn_requires = os.path.join(
+                    package.path, package.dist_name.replace("-", "_") + ".egg-info",
+                    "requires.txt")
+                fn_requirements = os.path.join(tmpdir, f"requirements{ipackage}.txt")
+                convert_requires(fn_requires, fn_requirements)
+                pip_args.append("-r " + fn_requirements)
+            # Install everything at once, such that pip resolves only once.
+            if pip_args:
+                ctx.run("pip install -U " + " ".join(pip_args))
         # Update the timestamp on the skip file.
         with open(fn_skip, 'w') as f:
             f.write(req_hash + '\n')
@@ -18,9 +18,12 @@
 # --
 """Unit tests roberto.requirements."""
 
+from glob import glob
 import os
+from types import SimpleNamespace
 
-from ..requirements import compute_req_hash
+from ..requirements import (compute_req_hash, extract_recipe_requirements, render_recipe,
+                            check_install_requirements)
 
 
 def test_req_hash(tmpdir):
@@ -50,3 +53,99 @@ def test_req_hash(tmpdir):
     assert hash1 != hash4
     assert hash2 != hash4
     assert hash3 != hash4
+    # Empty files are hashed by name only.
+    fn_empty = os.path.join(tmpdir, "empty")
+    with open(fn_empty, "w") as f:
+        pass
+    req_fns.add(fn_empty)
+    hash5 = compute_req_hash(req_items, req_fns)
+    assert len(hash5) == 64
+    assert hash4 != hash5
+
+
+def test_check_install_requirements(tmpdir):
+    fn_skip = os.path.join(tmpdir, ".skip_install")
+    assert check_install_requirements(fn_skip, "a"*64)
+    with open(fn_skip, "w") as f:
+        f.write("a"*64 + "\n")
+    assert not check_install_requirements(fn_skip, "a"*64)
+    assert check_install_requirements(fn_skip, "b"*64)
+    # Old skip files are ignored.
+    os.utime(fn_skip, (0, 0))
+    assert check_install_requirements(fn_skip, "a"*64)
+
+
+def test_extract_recipe_reqs():
+    rendered = {
+        "package": {"name": "foo", "version": "1.0.0"},
+        "requirements": {
+            "build": ["gcc_linux-64 7.3.0.*", "cmake >=3.10"],
+            "host": ["python 3.7.*", "numpy >=1.16,<2.0"],
+            "run": ["python >=3.7,<3.8.0a0", "foo-data"],
+        },
+        "test": {"requires": ["pytest"], "commands": ["pytest"]},
+        "about": {"license": "GPL-3.0"},
+    }
+    assert extract_recipe_requirements(rendered, ["foo-data"]) == {
+        "gcc_linux-64", "cmake >=3.10", "python", "numpy >=1.16,<2.0",
+        "python >=3.7,<3.8.0a0", "pytest"}
+    assert extract_recipe_requirements({"requirements": {"run": None}}, []) == set()
+    assert extract_recipe_requirements({}, []) == set()
+
+
+class FakeRenderContext(SimpleNamespace):
+    """Mimic the part of an invoke.Context used by render_recipe."""
+
+    def run(self, command, in_stream=None):
+        """Record the command and write a rendered recipe to the -f argument."""
+        assert in_stream is False
+        self.commands.append(command)
+        with open(command.split()[3], "w") as f:
+            f.write("requirements:\n  run:\n    - numpy\nabout:\n  license: GPL-3.0\n")
+
+
+def test_render_recipe(tmpdir):
+    recipe_dir = os.path.join(tmpdir, "conda.recipe")
+    os.mkdir(recipe_dir)
+    with open(os.path.join(recipe_dir, "meta.yaml"), "w") as f:
+        f.write("foo")
+    ctx = FakeRenderContext(
+        git=SimpleNamespace(tag_version="1.0.0"),
+        conda=SimpleNamespace(variants='"{python: \'3.7\'}"', channels=["conda-forge"]),
+        testenv=SimpleNamespace(path=str(tmpdir)),
+        commands=[],
+    )
+    # Irrelevant sections are not retained.
+    expected = {"requirements": {"run": ["numpy"]}}
+    assert render_recipe(ctx, recipe_dir) == expected
+    assert len(ctx.commands) == 1
+    assert len(glob(os.path.join(tmpdir, ".render_cache", "*.json"))) == 1
+    assert len(os.listdir(os.path.join(tmpdir, ".render_cache"))) == 1
+    # Second time, the cached result should be used.
+    assert render_recipe(ctx, recipe_dir) == expected
+    assert len(ctx.commands) == 1
+    # Render again after a change to the recipe or the version.
+    with open(os.path.join(recipe_dir, "meta.yaml"), "w") as f:
+        f.write("bar")
+    assert render_recipe(ctx, recipe_dir) == expected
+    assert len(ctx.commands) == 2
+    ctx.git.tag_version = "1.0.1"
+    assert render_recipe(ctx, recipe_dir) == expected
+    assert len(ctx.commands) == 3
+    # Files in subdirectories of the recipe are also taken into account.
+    os.mkdir(os.path.join(recipe_dir, "patches"))
+    with open(os.path.join(recipe_dir, "patches", "fix.patch"), "w") as f:
+        f.write("egg")
+    assert render_recipe(ctx, recipe_dir) == expected
+    assert len(ctx.commands) == 4
+    # Render again after a change of channels.
+    ctx.conda.channels = ["conda-forge", "theochem"]
+    assert render_recipe(ctx, recipe_dir) == expected
+    assert len(ctx.commands) == 5
+    # Old renders are not reused.
+    for fn_cached in glob(os.path.join(tmpdir, ".render_cache", "*.json")):
+        os.utime(fn_cached, (0, 0))
+    assert render_recipe(ctx, recipe_dir) == expected
+    assert len(ctx.commands) == 6
+    assert render_recipe(ctx, recipe_dir) == expected
+    assert len(ctx.commands) == 6
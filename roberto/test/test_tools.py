@@ -0,0 +1,118 @@
+# Collection of configurable development workflows
+# Copyright (C) 2011-2019 The Roberto Development Team
+#
+# This file is part of Roberto.
+#
+# Roberto is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 3
+# of the License, or (at your option) any later version.
+#
+# Roberto is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, see <http://www.gnu.org/licenses/>
+# --
+"""Unit tests roberto.tools."""
+
+import os
+import subprocess
+from types import SimpleNamespace
+
+from invoke import Config, Context, Failure, UnexpectedExit
+import pytest
+
+from ..tools import get_literal_command, format_command, RunCommands, UploadDocsGit
+
+
+def test_get_literal_command():
+    assert get_literal_command("make -C doc html") == "make -C doc html"
+    assert get_literal_command("echo ${{HOME}}") == "echo ${HOME}"
+    assert get_literal_command("twine upload {assets}") is None
+    assert get_literal_command("cd {package.path}; ls") is None
+
+
+def test_format_command():
+    fmtkwargs = {"assets": "a.tar.gz b.whl"}
+    assert format_command("echo ${{HOME}}", fmtkwargs) == "echo ${HOME}"
+    assert format_command("twine upload {assets}", fmtkwargs) == "twine upload a.tar.gz b.whl"
+
+
+def test_run_commands(tmpdir, capfd):
+    ctx = Context(Config(overrides={
+        "testenv": {"activate": "export FOO=bar"}, "run": {"in_stream": False}}))
+    package = SimpleNamespace(path=str(tmpdir))
+    fn_out = os.path.join(str(tmpdir), "out.txt")
+    # Changes of directory are confined to one command.
+    tool = RunCommands("x", [
+        "mkdir sub", "cd sub; pwd > {fn} # comment", "pwd >> {fn}; echo $FOO >> {fn}"])
+    tool.execute(ctx, package, {"fn": fn_out})
+    with open(fn_out) as f:
+        assert f.read().split() == [os.path.join(str(tmpdir), "sub"), str(tmpdir), "bar"]
+    assert f"RUN: cd sub; pwd > {fn_out} # comment" in capfd.readouterr().out
+    # Execution stops at the first failing command, which is shown in the output.
+    tool = RunCommands("x", ["true", "false", "touch never"])
+    with pytest.raises(UnexpectedExit):
+        tool.execute(ctx, package, {})
+    assert not os.path.exists(os.path.join(str(tmpdir), "never"))
+    out = capfd.readouterr().out
+    assert out.split()[-2:] == ["RUN:", "false"]
+
+
+def _git(cwd, *args):
+    """Run a git command and return its output."""
+    return subprocess.run(["git"] + list(args), cwd=cwd, check=True,
+                          stdout=subprocess.PIPE).stdout.decode("utf-8")
+
+
+def test_upload_docs_git(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.delenv("GITHUB_TOKEN", raising=False)
+    for name in "AUTHOR", "COMMITTER":
+        monkeypatch.setenv(f"GIT_{name}_NAME", "Roberto")
+        monkeypatch.setenv(f"GIT_{name}_EMAIL", "roberto@example.com")
+    monkeypatch.setattr("roberto.tools.need_deployment", lambda *args: True)
+    monkeypatch.setattr("roberto.tools.sanitize_branch", lambda ctx, branch: None)
+    # A repository in a subdirectory, with an orphan doc branch and a remote.
+    _git(".", "init", "-q", "--bare", "remote.git")
+    _git(".", "init", "-q", "repo")
+    _git("repo", "checkout", "-q", "-b", "main")
+    with open(os.path.join("repo", ".gitignore"), "w") as f:
+        f.write("doc/_build\n")
+    _git("repo", "add", ".gitignore")
+    _git("repo", "commit", "-q", "-m", "init")
+    _git("repo", "checkout", "-q", "--orphan", "gh-pages")
+    _git("repo", "rm", "-q", "-r", "-f", ".")
+    with open(os.path.join("repo", "old.html"), "w") as f:
+        f.write("old")
+    _git("repo", "add", "old.html")
+    _git("repo", "commit", "-q", "-m", "docs")
+    _git("repo", "checkout", "-q", "main")
+
+    ctx = Context(Config(overrides={
+        "git": {"branch": "main"}, "run": {"in_stream": False, "hide": True}}))
+    package = SimpleNamespace(path="repo", dist_name="foo")
+    fmtkwargs = {"package": package}
+    tool = UploadDocsGit("upload-docs-git", "{package.path}/doc/_build/html",
+                         "gh-pages", os.path.join(str(tmpdir), "remote.git"), ["release"])
+
+    # A missing or empty docroot must not result in an empty doc branch.
+    with pytest.raises(Failure):
+        tool.execute(ctx, package, fmtkwargs)
+    os.makedirs(os.path.join("repo", "doc", "_build", "html", "_static"))
+    with pytest.raises(Failure):
+        tool.execute(ctx, package, fmtkwargs)
+    assert _git("repo", "ls-tree", "-r", "--name-only", "gh-pages") == "old.html\n"
+
+    # Copy and stage the documentation, also files with spaces, dotfiles and
+    # names that git would otherwise interpret as pathspec magic or globs.
+    for fn_doc in "index.html", ".nojekyll", "_static/a b.css", ":x.html", "_static/*.js":
+        with open(os.path.join("repo", "doc", "_build", "html", fn_doc), "w") as f:
+            f.write(fn_doc)
+    tool.execute(ctx, package, fmtkwargs)
+    assert _git("remote.git", "ls-tree", "-r", "--name-only", "gh-pages").split("\n") == [
+        ".nojekyll", ":x.html", "_static/*.js", "_static/a b.css", "index.html", ""]
+    assert _git("repo", "rev-parse", "--abbrev-ref", "HEAD") == "main\n"
@@ -18,14 +18,19 @@
 # --
 """Unit tests Roberto.utils."""
 
+import hashlib
+import io
 import os
+import urllib.error
+import urllib.request
 
 import pytest
 
 from invoke.config import DataProxy
 
 from ..utils import (parse_git_describe, write_sha256_sum, TagError,
-                     check_env_var, need_deployment)
+                     check_env_var, need_deployment, download, check_download,
+                     compute_sha256, fast_glob)
 
 
 def test_parse_git_describe():
@@ -260,3 +265,121 @@ def test_write_sha256_sum_1000(tmpdir):
     with open(fn_hash, 'r') as f:
         assert f.read() == ("e3cf7ad45677ef171d77ec47e2dea492ba32e36b9d9fbcd0c9"
                             f"0951421d78bcc9  {fn_test}\n")
+
+
+def test_download(tmpdir):
+    fn_src = os.path.join(str(tmpdir), 'src.bin')
+    with open(fn_src, "wb") as f:
+        f.write(b"eggspam\n"*200000)
+    fn_dest = os.path.join(str(tmpdir), 'dest.bin')
+    download('file://' + fn_src, fn_dest)
+    assert not os.path.exists(fn_dest + '.part')
+    with open(fn_dest, "rb") as f:
+        assert f.read() == b"eggspam\n"*200000
+
+
+@pytest.mark.parametrize("file_digest", [True, False])
+def test_compute_sha256(tmpdir, monkeypatch, file_digest):
+    if not file_digest:
+        # Also test the fallback for Python < 3.11.
+        monkeypatch.delattr(hashlib, "file_digest", raising=False)
+    fn_test = os.path.join(str(tmpdir), 'a.bin')
+    with open(fn_test, "wb") as f:
+        f.write(b"foobar\n")
+    assert compute_sha256(fn_test) == (
+        "aec070645fe53ee3b3763059376134f058cc337247c978add178b6ccdfb0019f")
+
+
+def test_check_download(tmpdir):
+    fn_dest = os.path.join(str(tmpdir), 'dest.bin')
+    sha256 = "aec070645fe53ee3b3763059376134f058cc337247c978add178b6ccdfb0019f"
+    assert not check_download(fn_dest, sha256)
+    with open(fn_dest, "wb") as f:
+        f.write(b"foo")
+    # Without checksum, any existing file is reused.
+    assert check_download(fn_dest)
+    # A truncated file is removed.
+    assert not check_download(fn_dest, sha256)
+    assert not os.path.exists(fn_dest)
+    with open(fn_dest, "wb") as f:
+        f.write(b"foobar\n")
+    assert check_download(fn_dest, sha256)
+
+
+def test_download_resume_sha256(tmpdir):
+    fn_src = os.path.join(str(tmpdir), 'src.bin')
+    with open(fn_src, "wb") as f:
+        f.write(b"foobar\n")
+    fn_dest = os.path.join(str(tmpdir), 'dest.bin')
+    # A stale partial file is overwritten when the server ignores the range.
+    with open(fn_dest + '.part', "wb") as f:
+        f.write(b"foo")
+    sha256 = "aec070645fe53ee3b3763059376134f058cc337247c978add178b6ccdfb0019f"
+    download('file://' + fn_src, fn_dest, sha256)
+    with open(fn_dest, "rb") as f:
+        assert f.read() == b"foobar\n"
+    with pytest.raises(RuntimeError):
+        download('file://' + fn_src, fn_dest, "0"*64)
+    assert not os.path.exists(fn_dest + '.part')
+
+
+class FakeResponse(io.BytesIO):
+    """Mimic an HTTP response returned by urlopen."""
+
+    def __init__(self, data, status):
+        super().__init__(data)
+        self.status = status
+
+
+def test_download_resume_mocked(tmpdir, monkeypatch):
+    fn_dest = os.path.join(str(tmpdir), 'dest.bin')
+    sha256 = "aec070645fe53ee3b3763059376134f058cc337247c978add178b6ccdfb0019f"
+    ranges = []
+
+    def fake_urlopen(request):
+        ranges.append(request.get_header('Range'))
+        if request.get_header('Range') == 'bytes=3-':
+            return FakeResponse(b"bar\n", 206)
+        if request.get_header('Range') == 'bytes=7-':
+            raise urllib.error.HTTPError(request.full_url, 416, "", {}, None)
+        return FakeResponse(b"foobar\n", 200)
+
+    monkeypatch.setattr(urllib.request, "urlopen", fake_urlopen)
+    # Resume with a range request (206) when a checksum is given.
+    with open(fn_dest + '.part', "wb") as f:
+        f.write(b"foo")
+    download('https://example.com/a.bin', fn_dest, sha256)
+    assert ranges == ['bytes=3-']
+    with open(fn_dest, "rb") as f:
+        assert f.read() == b"foobar\n"
+    # A complete partial file (416) is accepted after verification.
+    with open(fn_dest + '.part', "wb") as f:
+        f.write(b"foobar\n")
+    download('https://example.com/a.bin', fn_dest, sha256)
+    assert ranges[1:] == ['bytes=7-']
+    with open(fn_dest, "rb") as f:
+        assert f.read() == b"foobar\n"
+    # Without a checksum, a partial file is never resumed.
+    with open(fn_dest + '.part', "wb") as f:
+        f.write(b"foo")
+    download('https://example.com/a.bin', fn_dest)
+    assert ranges[2:] == [None]
+    with open(fn_dest, "rb") as f:
+        assert f.read() == b"foobar\n"
+    assert not os.path.exists(fn_dest + '.part')
+
+
+def test_fast_glob(tmpdir):
+    tmpdir = str(tmpdir)
+    for filename in ["a-1.0.tar.gz", "a-1.0.tar.gz.sha256", "b-1.0.tar.gz", ".a-1.0"]:
+        with open(os.path.join(tmpdir, filename), "w") as f:
+            f.write("foo")
+    os.mkdir(os.path.join(tmpdir, "dist"))
+    with open(os.path.join(tmpdir, "dist", "a-1.0.whl"), "w") as f:
+        f.write("foo")
+    assert sorted(fast_glob(os.path.join(tmpdir, "a-1.0.*"))) == [
+        os.path.join(tmpdir, "a-1.0.tar.gz"), os.path.join(tmpdir, "a-1.0.tar.gz.sha256")]
+    assert fast_glob(os.path.join(tmpdir, ".a-*")) == [os.path.join(tmpdir, ".a-1.0")]
+    assert fast_glob(os.path.join(tmpdir, "*dist*", "a-1.0.*")) == [
+        os.path.join(tmpdir, "dist", "a-1.0.whl")]
+    assert fast_glob(os.path.join(tmpdir, "missing", "*")) == []
@@ -24,28 +24,29 @@ essentially groups of methods with compatible API, yet with implementation
 details that may differ.
 """
 
-import json
 import os
-import platform
 import stat
 import subprocess
-import urllib.request
+import sys
 
 from invoke import Failure
 
+from .utils import check_download, download
 
-def append_activate(ctx, line):
-    """Append a line to the activate script and show it."""
+
+def append_activate(ctx, *lines):
+    """Append lines to the activate script, with a single write, and show them."""
     mode = "w" if ctx.testenv.activate == "true" else "a"
     with open(ctx.testenv.fn_activate, mode) as f:
-        f.write(line + "\n")
-    print(f"\033[0;96m   ENV:  {line}\033[0;0m")
+        f.write("".join(line + "\n" for line in lines))
+    for line in lines:
+        print(f"\033[0;96m   ENV:  {line}\033[0;0m")
     ctx.testenv.activate = "source " + os.path.abspath(ctx.testenv.fn_activate)
 
 
 def install_macosx_sdk(ctx):
     """Install MacOSX SDK if on OSX if needed."""
-    if platform.system() == 'Darwin' and ctx.macosx.install_sdk:
+    if sys.platform == 'darwin' and ctx.macosx.install_sdk:
         optdir = os.path.join(ctx.testenv.base_path, 'opt')
         if not os.path.isdir(optdir):
             os.makedirs(optdir)
@@ -54,13 +55,18 @@ def install_macosx_sdk(ctx):
         if not os.path.isdir(sdk_root):
             sdk_tar = f'{sdk}.tar.xz'
             sdk_dwnl = os.path.join(ctx.download_dir, sdk_tar)
-            sdk_url = f'{ctx.maxosx.sdk_release}/{sdk_tar}'
-            print(f"Downloading {sdk_url}")
-            urllib.request.urlretrieve(sdk_url, sdk_dwnl)
-            with ctx.cd(optdir):
-                ctx.run(f'tar -xJf {sdk_dwnl}')
-        append_activate(ctx, "export MACOSX_DEPLOYMENT_TARGET=" + ctx.macosx.release)
-        append_activate(ctx, f'export SDKROOT="{sdk_root}"')
+            if check_download(sdk_dwnl, ctx.macosx.sdk_sha256):
+                print(f"MacOSX SDK already present: {sdk_dwnl}")
+            else:
+                sdk_url = f'{ctx.macosx.sdk_release}/{sdk_tar}'
+                print(f"Downloading {sdk_url}")
+                download(sdk_url, sdk_dwnl, ctx.macosx.sdk_sha256)
+            ctx.run(f'tar -xJf {sdk_dwnl} -C {optdir}')
+        append_activate(
+            ctx,
+            "export MACOSX_DEPLOYMENT_TARGET=" + ctx.macosx.release,
+            f'export SDKROOT="{sdk_root}"',
+        )
         print(f'MaxOSX sdk in: {sdk_root}')
         ctx.run(f'ls -alh {sdk_root}')
         ctx.macosx.sdk_root = sdk_root
@@ -97,16 +103,17 @@ def install_conda(ctx):
     # Install miniconda if needed.
     if not os.path.isdir(os.path.join(ctx.testenv.base_path, 'bin')):
         dwnlconda = os.path.join(ctx.download_dir, 'miniconda.sh')
-        if os.path.isfile(dwnlconda):
+        if sys.platform == 'darwin':
+            url, sha256 = ctx.conda.osx_url, ctx.conda.osx_sha256
+        elif sys.platform.startswith('linux'):
+            url, sha256 = ctx.conda.linux_url, ctx.conda.linux_sha256
+        else:
+            raise Failure(f"Operating system {sys.platform} not supported.")
+        if check_download(dwnlconda, sha256):
             print(f"Conda installer already present: {dwnlconda}")
         else:
             print(f"Downloading latest conda to {dwnlconda}.")
-            if platform.system() == 'Darwin':
-                urllib.request.urlretrieve(ctx.conda.osx_url, dwnlconda)
-            elif platform.system() == 'Linux':
-                urllib.request.urlretrieve(ctx.conda.linux_url, dwnlconda)
-            else:
-                raise Failure(f"Operating system {platform.system()} not supported.")
+            download(url, dwnlconda, sha256)
 
         # Fix permissions of the conda installer.
         os.chmod(dwnlconda, os.stat(dwnlconda).st_mode | stat.S_IXUSR)
@@ -132,9 +139,9 @@ def setup_conda(ctx):
         ctx.conda.build_path = os.path.join(ctx.testenv.path, 'conda-bld')
 
     # Check the sanity of the pinning configuration
-    for char in "=<>!*":
-        if char in ctx.conda.pinning:
-            raise Failure(f"Character '{char}' should not be used in pinning.")
+    bad_chars = set("=<>!*").intersection(ctx.conda.pinning)
+    if bad_chars:
+        raise Failure(f"Characters {''.join(sorted(bad_chars))} should not be used in pinning.")
     pinned_words = ctx.conda.pinning.split()
     if len(pinned_words) % 2 != 0:
         raise Failure("Pinning config should be an even number of words, alternating "
@@ -151,23 +158,29 @@ def setup_conda(ctx):
         f"{name}: '{version}'" for name, version
         in zip(pinned_words[::2], pinned_words[1::2])) + '}"'
 
-    append_activate(ctx, '[[ -n \"${CONDA_PREFIX_1}\" ]] && conda deactivate &> /dev/null')
-    append_activate(ctx, '[[ -n \"${CONDA_PREFIX}\" ]] && conda deactivate &> /dev/null')
-    append_activate(ctx, ctx.conda.activate_base)
-
-    with ctx.prefix(ctx.testenv.activate):
-        # Check if the right environment exists, and make if needed.
-        result = ctx.run("conda env list --json")
-        print(f"Required conda env: {ctx.testenv.path}")
-        if ctx.testenv.path not in json.loads(result.stdout)["envs"]:
+    append_activate(
+        ctx,
+        '[[ -n \"${CONDA_PREFIX_1}\" ]] && conda deactivate &> /dev/null',
+        '[[ -n \"${CONDA_PREFIX}\" ]] && conda deactivate &> /dev/null',
+        ctx.conda.activate_base,
+    )
+
+    # Check if the right environment exists, and make if needed. Every conda
+    # environment has a conda-meta directory, so there is no need to ask conda.
+    print(f"Required conda env: {ctx.testenv.path}")
+    if not os.path.isdir(os.path.join(ctx.testenv.path, "conda-meta")):
+        with ctx.prefix(ctx.testenv.activate):
             ctx.run(f"conda create -n {ctx.testenv.name} {' '.join(pinned_reqs)} -y")
             with open(os.path.join(ctx.testenv.path, "conda-meta", "pinning"), "w") as f:
                 for pin in pinned_reqs:
                     f.write(pin + "\n")
 
-    append_activate(ctx, f'conda activate {ctx.testenv.name}')
-    append_activate(ctx, f'export CONDA_BLD_PATH="{ctx.conda.build_path}"')
-    append_activate(ctx, f'export PROJECT_VERSION="{ctx.git.tag_version}"')
+    append_activate(
+        ctx,
+        f'conda activate {ctx.testenv.name}',
+        f'export CONDA_BLD_PATH="{ctx.conda.build_path}"',
+        f'export PROJECT_VERSION="{ctx.git.tag_version}"',
+    )
 
     with ctx.prefix(ctx.testenv.activate):
         # Reset the channels. Removing previous may fail if there were none. That's ok.
@@ -215,8 +228,11 @@ def setup_venv(ctx):
     else:
         print("Virtual environment already exists:")
         print(ctx.testenv.path)
-    append_activate(ctx, '[[ -n "${VIRTUAL_ENV}" ]] && deactivate &> /dev/null')
-    append_activate(ctx, f"source {ctx.testenv.path}/bin/activate")
+    append_activate(
+        ctx,
+        '[[ -n "${VIRTUAL_ENV}" ]] && deactivate &> /dev/null',
+        f"source {ctx.testenv.path}/bin/activate",
+    )
 
     install_macosx_sdk(ctx)
 
@@ -19,15 +19,19 @@
 """Tools contribute functionality to tasks."""
 
 
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import io
 import json
 import os
-import urllib.request
+import shlex
+import shutil
+from string import Formatter
 
-from invoke import UnexpectedExit
+from invoke import Failure, UnexpectedExit
 
 from .utils import (sanitize_branch, need_deployment,
-                    check_env_var, write_sha256_sum)
+                    check_env_var, write_sha256_sum, fast_glob)
 from .testenvs import append_activate
 
 
@@ -70,6 +74,67 @@ def execute_tools(ctx, tool_cls):
                 tool.execute(ctx, package, fmtkwargs)
 
 
+@lru_cache(maxsize=None)
+def get_literal_command(command: str):
+    """Return a command without replacement fields, with escaped braces resolved.
+
+    Parameters
+    ----------
+    command
+        A command, possibly with replacement fields to be filled in by
+        str.format.
+
+    Returns
+    -------
+    literal
+        The command as it would be formatted, or None if the command contains
+        replacement fields. Results are cached, such that each command needs
+        to be parsed only once.
+
+    """
+    parts = list(Formatter().parse(command))
+    if any(field_name is not None for _literal, field_name, _spec, _conv in parts):
+        return None
+    return "".join(literal for literal, _field_name, _spec, _conv in parts)
+
+
+def format_command(command: str, fmtkwargs: dict) -> str:
+    """Fill in the replacement fields of a command, skipping str.format when possible."""
+    literal = get_literal_command(command)
+    if literal is None:
+        return command.format_map(fmtkwargs)
+    return literal
+
+
+@lru_cache(maxsize=None)
+def get_github_user_info(token: str) -> dict:
+    """Get information on the owner of a GitHub token.
+
+    The result is cached, such that the GitHub API is contacted only once,
+    also when documentation of several packages is uploaded.
+
+    Parameters
+    ----------
+    token
+        A GitHub token.
+
+    Returns
+    -------
+    user_info
+        The user information from the GitHub API. This is empty when the
+        token has no permission to access user information.
+
+    """
+    import urllib.request  # pylint: disable=import-outside-toplevel
+    req = urllib.request.Request('https://api.github.com/user')
+    req.add_header('Authorization', f'token {token}')
+    try:
+        with urllib.request.urlopen(req) as f:
+            return json.load(f)
+    except urllib.error.HTTPError:
+        return {}
+
+
 class Tool:
     """Tool base class."""
 
@@ -95,10 +160,22 @@ class Tool:
 
     @staticmethod
     def _run_commands(ctx, package, fmtkwargs, commands):
-        """Run all commengs for a given package, performanc variable substitution."""
+        """Run all commengs for a given package, performanc variable substitution.
+
+        All commands are executed in a single shell, such that the testenv
+        is activated only once. Each command runs in its own subshell, to
+        isolate changes of directory or variables, and the first failing
+        command stops the execution of the remaining ones. Each command is
+        announced in the output, to show which one failed.
+        """
+        if not commands:
+            return
+        parts = []
+        for command in commands:
+            command = format_command(command, fmtkwargs)
+            parts.append(f"echo {shlex.quote('RUN: ' + command)} && (\n{command}\n)")
         with ctx.cd(package.path), ctx.prefix(ctx.testenv.activate):
-            for command in commands:
-                ctx.run(command.format(**fmtkwargs))
+            ctx.run(" && ".join(parts))
 
 
 class WriteVersion(Tool):
@@ -123,11 +200,22 @@ class WriteVersion(Tool):
 
     def execute(self, ctx, package, fmtkwargs):
         """Execute the tool for a given package."""
-        fn_version = self.destination.format(**fmtkwargs)
-        content = self.template.format(**fmtkwargs)
-        with open(os.path.join(package.path, fn_version), 'w') as f:
-            f.write(content)
-        print("Version file written to:", fn_version)
+        fn_version = self.destination.format_map(fmtkwargs)
+        content = self.template.format_map(fmtkwargs)
+        path = os.path.join(package.path, fn_version)
+        # Leave an up-to-date file untouched, to keep its timestamp unchanged.
+        # This avoids needless rebuilds by tools which rely on timestamps.
+        try:
+            with open(path) as f:
+                unchanged = f.read() == content
+        except FileNotFoundError:
+            unchanged = False
+        if unchanged:
+            print("Version file is up to date:", fn_version)
+        else:
+            with open(path, 'w') as f:
+                f.write(content)
+            print("Version file written to:", fn_version)
 
 
 class Lint(Tool):
@@ -197,6 +285,8 @@ class BuildInPlace(Tool):
 
     def _check_vars(self):
         """Print out some variables who might reveal issues."""
+        if not self.check_vars:
+            return
         print('Existing variables that could affect the in-place build:')
         for varname in self.check_vars:
             if varname in os.environ:
@@ -204,10 +294,13 @@ class BuildInPlace(Tool):
 
     def _update_extra_vars(self, ctx, fmtkwargs):
         """Update environment variables after running build commands."""
+        lines = []
         for name, value in self.extra_vars.items():
             separator = ":" if "PATH" in name else " "
-            value = value.format(**fmtkwargs)
-            append_activate(ctx, f'export {name}="${{{name}:+${{{name}}}{separator}}}{value}"')
+            value = value.format_map(fmtkwargs)
+            lines.append(f'export {name}="${{{name}:+${{{name}}}{separator}}}{value}"')
+        if lines:
+            append_activate(ctx, *lines)
 
     def execute(self, ctx, package, fmtkwargs):
         """Execute the tool for a given package."""
@@ -285,15 +378,7 @@ class UploadDocsGit(UploadDocs):
         # Try to get a git username and author argument for the doc commit.
         if 'GITHUB_TOKEN' in os.environ:
             # First get user info from the owner of the token
-            req = urllib.request.Request('https://api.github.com/user')
-            req.add_header('Authorization', f'token {os.environ["GITHUB_TOKEN"]}')
-            try:
-                with urllib.request.urlopen(req) as f:
-                    user_info = json.loads(f.read().decode('utf-8'))['login']
-            except urllib.error.HTTPError:
-                # The exception may be raised when the token has no permission to
-                # access user information.
-                user_info = {}
+            user_info = get_github_user_info(os.environ["GITHUB_TOKEN"])
             author_name = user_info.get("name", user_info.get("login", "Roberto"))
             fallback_email = user_info.get("login", "roberto") + "@users.noreply.github.com"
             author_email = user_info.get("email", fallback_email)
@@ -307,21 +392,38 @@ class UploadDocsGit(UploadDocs):
         if not need_deployment(ctx, prefix, False, self.deploy_labels):
             return
 
+        # Collect the documentation files, relative to the docroot. The
+        # docroot template already includes the package path, if needed.
+        docroot = self.docroot.format_map(fmtkwargs)
+        if not os.path.isdir(docroot):
+            raise Failure(f"Documentation directory {docroot} does not exist.")
+        fullfns = []
+        for root, _dirs, filenames in os.walk(docroot):
+            reldir = os.path.relpath(root, docroot)
+            for filename in filenames:
+                fullfns.append(os.path.normpath(os.path.join(reldir, filename)))
+        if not fullfns:
+            raise Failure(f"Documentation directory {docroot} is empty.")
+
         with ctx.cd(package.path):
             # Switch to a docu branch and remove everything that was present in
             # the previous commit. It is assumed that the doc branch is an
             # orphan branch made previously.
             sanitize_branch(ctx, self.docbranch)
             ctx.run(f"git checkout {self.docbranch}")
-            ctx.run("git ls-tree HEAD -r --name-only | xargs rm")
-            # Copy the documentation to the repo root.
-            docroot = self.docroot.format(**fmtkwargs)
-            ctx.run(f"GLOBIGNORE='.:..'; cp -rv {docroot}/* .")
-            # Add all files
-            for root, _dirs, filenames in os.walk(docroot):
-                for filename in filenames:
-                    fullfn = os.path.join(root, filename)[len(docroot)+1:]
-                    ctx.run(f"git add {fullfn}")
+            ctx.run("git rm -r -f -q --ignore-unmatch .")
+            # Copy the documentation to the repo root, without a subprocess.
+            # (shutil.copytree can only copy into an existing directory as of
+            # Python 3.8.)
+            for fullfn in fullfns:
+                dst = os.path.join(package.path, fullfn)
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(os.path.join(docroot, fullfn), dst)
+            print(f"Copied {len(fullfns)} files from {docroot}")
+            # Add all files with a single git command. (git add -A would also
+            # pick up untracked files outside the docroot.)
+            ctx.run("git --literal-pathspecs add --pathspec-from-file=- --pathspec-file-nul",
+                    in_stream=io.StringIO("".join(fullfn + "\0" for fullfn in fullfns)))
             # Commit, push and go back to the original branch
             ctx.run("git commit -a -m 'Automatic documentation update' --amend ")
             ctx.run(f"git checkout {ctx.git.branch}")
@@ -391,20 +493,23 @@ class Deploy(Tool):
         for binary, asset_patterns in [(True, self.binary_asset_patterns),
                                        (False, self.noarch_asset_patterns)]:
             # Fill in config variables in asset_patterns
-            asset_patterns = [pattern.format(**fmtkwargs) for pattern in asset_patterns]
+            asset_patterns = [pattern.format_map(fmtkwargs) for pattern in asset_patterns]
             descr = f'{self.name} of {package.dist_name} (binary={binary})'
             print(f"Preparing for {descr}")
             # Collect assets, skipping hash files previously generated.
             assets = []
             for pattern in asset_patterns:
                 print("  Searching for", pattern)
-                assets.extend([filename for filename in glob(pattern)
+                assets.extend([filename for filename in fast_glob(pattern)
                                if not filename.endswith("sha256")])
             if not assets:
                 print("No assets found")
                 continue
-            # Make sha256 checksums
-            asset_hashes = [write_sha256_sum(asset) for asset in assets]
+            # Make sha256 checksums, concurrently because hashlib releases the
+            # GIL while hashing large files.
+            max_workers = min(len(assets), os.cpu_count() or 1)
+            with ThreadPoolExecutor(max_workers) as executor:
+                asset_hashes = list(executor.map(write_sha256_sum, assets))
             if self.include_sha256:
                 assets.extend(asset_hashes)
             # Print final assets
@@ -19,12 +19,36 @@
 """Utilities used by tasks in Roberto's workflow."""
 
 
+from fnmatch import fnmatch
 import hashlib
 import os
 import re
+import shutil
 from typing import List
 
-from invoke import Context, Failure
+from invoke import Context
+import yaml
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+def load_yaml(stream):
+    """Load a YAML document safely, with the LibYAML parser when available.
+
+    Parameters
+    ----------
+    stream
+        A string or an open file with the YAML document.
+
+    Returns
+    -------
+    data
+        The loaded document.
+
+    """
+    return yaml.load(stream, Loader=SafeLoader)
 
 
 def parse_git_describe(git_describe: str) -> dict:
@@ -123,7 +147,8 @@ def sanitize_branch(ctx: Context, branch: str):
     """Attempt to fix the presence of a branch.
 
     The branch is checked with rev-parse. If not present, try to set it to
-    origin/branch. If that does not work, try to fetch it.
+    origin/branch. If that does not work, try to fetch it. All attempts are
+    chained in a single shell command.
 
     Parameters
     ----------
@@ -133,22 +158,15 @@ def sanitize_branch(ctx: Context, branch: str):
         The branch to resurrect.
 
     """
-    # Test if merge branch is present
-    try:
-        ctx.run(f"git rev-parse --verify {branch}")
-        return
-    except Failure:
-        print(f"Merge branch \"{branch}\" not found.")
-
-    # Try to create it without connection to origin
-    try:
-        ctx.run(f"git branch --track {branch} origin/{branch}")
-        return
-    except Failure:
-        print(f"Local copy of remote merge branch \"{branch}\" not found.")
-
-    # Last resort: fetch the merge branch
-    ctx.run(f"git fetch origin {branch}:{branch}")
+    # Test if the branch is present, or else try to create it without
+    # connection to origin, or as a last resort, fetch the branch.
+    # The branch may also be given as a commit sha (e.g. on CI), which is why
+    # rev-parse is used instead of show-ref on refs/heads.
+    ctx.run(
+        f"git rev-parse --quiet --verify {branch} > /dev/null || "
+        f"git branch --track {branch} origin/{branch} || "
+        f"git fetch origin {branch}:{branch}"
+    )
 
 
 def check_env_var(name: str):
@@ -160,9 +178,10 @@ def check_env_var(name: str):
         The environment variable to be checked.
 
     """
-    if name not in os.environ:
+    value = os.environ.get(name)
+    if value is None:
         return f'The environment variable {name} is not set.'
-    if os.environ[name] == "":
+    if value == "":
         return f'The environment variable {name} is empty.'
     return f'The environment variable {name} is not empty.'
 
@@ -197,6 +216,126 @@ def need_deployment(ctx: Context, prefix: str, binary: bool, deploy_labels: List
     return True
 
 
+def download(url: str, fn_dest: str, sha256: str = None):
+    """Download a file in large chunks, such that it only appears when complete.
+
+    Parameters
+    ----------
+    url
+        The URL of the file to download.
+    fn_dest
+        The destination filename. The data are first written to a file with
+        suffix ``.part``, which is renamed to fn_dest after the download
+        has completed. When a partial file is present from an interrupted
+        download and a checksum is given, the download is resumed if the
+        server supports it. Without a checksum, the partial file may belong to
+        an older release behind the same URL, so it is discarded.
+    sha256
+        The expected sha256 checksum (hex digest) of the file. When given and
+        the downloaded file does not match, it is downloaded once more from
+        scratch before giving up.
+
+    """
+    import urllib.request  # pylint: disable=import-outside-toplevel
+    fn_part = fn_dest + '.part'
+    for _attempt in range(2):
+        request = urllib.request.Request(url)
+        # Only resume when the result can be verified with the checksum.
+        resume = sha256 is not None and os.path.isfile(fn_part)
+        if resume:
+            request.add_header('Range', f'bytes={os.path.getsize(fn_part)}-')
+        try:
+            with urllib.request.urlopen(request) as response:
+                # Only append when the server sends the requested range.
+                mode = 'ba' if resume and getattr(response, 'status', None) == 206 else 'bw'
+                with open(fn_part, mode) as f:
+                    shutil.copyfileobj(response, f, 1024*1024)
+        except urllib.error.HTTPError as exc:
+            # 416 means that the partial file may be complete already, which
+            # is verified below.
+            if not (resume and exc.code == 416):
+                raise
+        if sha256 is None or compute_sha256(fn_part) == sha256:
+            os.replace(fn_part, fn_dest)
+            return
+        print(f"Checksum mismatch for {url}. Downloading again.")
+        os.remove(fn_part)
+    raise RuntimeError(f"The sha256 checksum of {url} is not {sha256}.")
+
+
+def check_download(fn_dest: str, sha256: str = None) -> bool:
+    """Check if a previously downloaded file can be reused.
+
+    Parameters
+    ----------
+    fn_dest
+        The destination filename of the download.
+    sha256
+        The expected sha256 checksum (hex digest) of the file, if known. When
+        the existing file does not match, it is removed.
+
+    Returns
+    -------
+    present
+        True when the file exists and, if a checksum is given, matches it.
+
+    """
+    if not os.path.isfile(fn_dest):
+        return False
+    if sha256 is not None and compute_sha256(fn_dest) != sha256:
+        print(f"Checksum mismatch for {fn_dest}. Downloading again.")
+        os.remove(fn_dest)
+        return False
+    return True
+
+
+def compute_sha256(fn_asset: str) -> str:
+    """Return the hex digest of the sha256 checksum of a file."""
+    with open(fn_asset, 'br') as f:
+        if hasattr(hashlib, "file_digest"):
+            # Python >= 3.11: hashing with a reused buffer, without the GIL.
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        hasher = hashlib.sha256()
+        for chunck in iter(lambda: f.read(1024*1024), b""):
+            hasher.update(chunck)
+    return hasher.hexdigest()
+
+
+def fast_glob(pattern: str) -> List[str]:
+    """Return filenames matching a pattern, like glob but with a single directory scan.
+
+    Only the last path component of the pattern is matched by scanning its
+    directory. When the directory part also contains wildcards, this
+    function falls back to glob.
+
+    Parameters
+    ----------
+    pattern
+        The glob pattern.
+
+    Returns
+    -------
+    filenames
+        The list of matching filenames.
+
+    """
+    dirname, basename = os.path.split(pattern)
+    if re.search(r'[*?[]', dirname):
+        from glob import glob  # pylint: disable=import-outside-toplevel
+        return glob(pattern)
+    # Like glob, only match hidden files if the pattern starts with a dot.
+    hidden = basename.startswith('.')
+    try:
+        with os.scandir(dirname or os.curdir) as entries:
+            return [
+                os.path.join(dirname, entry.name) for entry in entries
+                if (hidden or not entry.name.startswith('.'))
+                and fnmatch(entry.name, basename)
+            ]
+    except OSError:
+        return []
+
+
 def write_sha256_sum(fn_asset: str) -> str:
     """Make a sha256 checksum file, print it and return the checksum filename.
 
@@ -211,13 +350,9 @@ def write_sha256_sum(fn_asset: str) -> str:
         The filename of the file containing the hash.
 
     """
-    hasher = hashlib.sha256()
-    with open(fn_asset, 'br') as f:
-        for chunck in iter(lambda: f.read(4096), b""):
-            hasher.update(chunck)
     fn_sha256 = fn_asset + '.sha256'
     with open(fn_sha256, 'w') as f:
-        line = f'{hasher.hexdigest()}  {fn_asset}'
+        line = f'{compute_sha256(fn_asset)}  {fn_asset}'
         f.write(line + '\n')
         print(line)
     return fn_sha256